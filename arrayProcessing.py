@@ -6,6 +6,10 @@
 
 import pylab as pl
 import scipy.signal
+try:
+    import numba
+except ImportError:  # numba is optional: filter_cosmic_rays then uses scipy.signal.medfilt
+    numba = None
 
 def smooth(x,window_len=11,window='hanning'):
     """smooth the data using a window with requested size.
@@ -67,6 +71,45 @@ def smooth(x,window_len=11,window='hanning'):
     return y[int(pl.floor(window_len/2)) : -int(pl.ceil(window_len/2) - 1)]
 
 
+def _median_filter(spectrum, filter_size):
+    """
+    Median filter of a 1D array, zero-padded at the edges (same output as scipy.signal.medfilt).
+    Each window is sorted with an insertion sort (fast for the small windows used here).
+    Compiled with numba when it is installed (serial: spectra are small and batches are already run in parallel processes).
+    
+    Args:
+        spectrum (numpy array): a 1D numpy array
+        filter_size (int): number of pixels of the median window (odd)
+    
+    Returns:
+        numpy array: the filtered array (same dtype as spectrum).
+    """
+    n_pixels = spectrum.shape[0]
+    half_size = filter_size // 2
+    zero = pl.zeros(1, spectrum.dtype)[0]  # padding value, same type as the data
+    spectrum_filtered = pl.empty_like(spectrum)
+    window = pl.empty(filter_size, spectrum.dtype)
+    for i in range(n_pixels):
+        for k in range(filter_size):
+            j = i + k - half_size
+            if j >= 0 and j < n_pixels:
+                value = spectrum[j]
+            else:
+                value = zero
+            m = k
+            while m > 0 and window[m - 1] > value:
+                window[m] = window[m - 1]
+                m -= 1
+            window[m] = value
+        spectrum_filtered[i] = window[half_size]
+    
+    return spectrum_filtered
+
+
+if numba is not None:
+    _median_filter = numba.njit(cache=True)(_median_filter)
+
+
 def filter_cosmic_rays(spectrum, error_thr=10., filter_size=5):
     """
     Filters out cosmic rays from a 1D spectrum (simple spike detection algorithm).
@@ -81,7 +124,12 @@ def filter_cosmic_rays(spectrum, error_thr=10., filter_size=5):
         numpy array: the spectrum corrected (spikes removed).
     """
 
-    spectrum_smooth = scipy.signal.medfilt(spectrum, filter_size)
+    if numba is not None:
+        if filter_size % 2 == 0:
+            raise ValueError("filter_size should be odd.")
+        spectrum_smooth = _median_filter(pl.asarray(spectrum), filter_size)
+    else:
+        spectrum_smooth = scipy.signal.medfilt(spectrum, filter_size)
     bad_pixels = pl.absolute(spectrum - spectrum_smooth) > float(error_thr)
     spectrum_corr = spectrum.copy()
     spectrum_corr[bad_pixels] = spectrum_smooth[bad_pixels]
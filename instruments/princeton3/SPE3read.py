@@ -9,13 +9,27 @@ This library allows to read SPE3 files generated by Princeton Instruments Lightf
 
 This is a python 3 library tested with python 3.6 - RProux 17/10/2017
 
+"""
+import functools
+import os
+import struct
+import numpy as np
+import xml.etree.ElementTree as ET
 
-IMPORTANT NOTE: needs the xmltodict package to work. 
-If not installed install it using PIP typing "pip install xmltodict" in a terminal
+def _localTag(element):
+    """Returns the tag of an XML element without its namespace (i.e. 'Wavelength' for '{http://...}Wavelength')"""
+    return element.tag.rsplit('}', 1)[-1]
+
+
+@functools.lru_cache(maxsize=32)
+def _parseWavelengths(wavelengthStr):
+    """Converts the comma-separated wavelength calibration into a (read-only) numpy array.
+    Cached since files of a same measurement series usually share the same calibration.
+    """
+    wavelength = np.fromstring(wavelengthStr, dtype=np.float64, sep=',')
+    wavelength.flags.writeable = False
+    return wavelength
 
-"""
-import pylab as pl
-import xmltodict
 
 class SPE3map:
 
@@ -24,7 +38,7 @@ class SPE3map:
     Reliable attributes (standardized interface): data, exposureTime, nbOfFrames, regionSize, SPEversion and wavelength.
     
     Attributes:
-        data (numpy array): numpy array containing the frames
+        data (numpy array): numpy array containing the frames (a memory mapped view of the file when opened from a filename)
         DATAOFFSET (int): offset to the binary data is fixed (4100 bytes) in SPE 2.X/3 file format
         dataType (short): experiment datatype (0 = float (4 bytes), 1 = long (4 bytes), 2 = short (2 bytes), 3 = unsigned short (2 bytes))
         exposureTime (float): exposure time of each frame in seconds
@@ -60,6 +74,7 @@ class SPE3map:
         """
 
         self._fid = None
+        self._fname = None
         self.fname = fname
         if fname is not None:
             self.openFile(fname)
@@ -72,6 +87,7 @@ class SPE3map:
 
     def readData(self):
         """Read all the data into the class"""
+        self._readHeader()
         self._readSPEversion()
         try:
             assert(self.SPEversion >= 3)# or print 'This file is not a SPE 3.x file.'
@@ -86,8 +102,9 @@ class SPE3map:
         self._readArray()
 
         # Store other useful info
-        self.center_wavelength = int(float(self._footerInfo['SpeFormat']['DataHistories']['DataHistory']['Origin']['Experiment']['Devices']['Spectrometers']['Spectrometer']['Grating']['CenterWavelength']['#text']))
-        self.grating = self._footerInfo['SpeFormat']['DataHistories']['DataHistory']['Origin']['Experiment']['Devices']['Spectrometers']['Spectrometer']['Grating']['Selected']['#text']
+        gratingPath = 'DataHistories/DataHistory/Origin/Experiment/Devices/Spectrometers/Spectrometer/Grating/'
+        self.center_wavelength = int(float(self._findInFooter(gratingPath + 'CenterWavelength').text))
+        self.grating = self._findInFooter(gratingPath + 'Selected').text.strip()
 
 
     def openFile(self, fname):
@@ -98,101 +115,127 @@ class SPE3map:
         self._fname = fname
         self._fid = open(fname, "rb")
 
-    def _readAtNumpy(self, pos, size, ntype):
-        """Reads a number from the file.
-
-        Args:
-            pos (int): Position in the file in bytes
-            size (int): Number of elements to read (-1 for all items)
-            ntype (data-type): Type of number (number of bytes to read = sizeof(ntype) * size)
-
-        Returns:
-            number or numpy array: numpy array of read numbers if several numbers (size > 1). Simple number otherwise.
-        """
-        self._fid.seek(pos)
-#        print(ntype, type(ntype), size, type(size))
-        return pl.fromfile(self._fid, ntype, int(size))
+    def _readHeader(self):
+        """Reads the whole fixed-size binary header (DATAOFFSET bytes) in _header"""
+        self._fid.seek(0)
+        self._header = self._fid.read(self.DATAOFFSET)
 
     def _readSPEversion(self):
-        """Determines SPE file version (always there in SPE 2.x or 3.0 files)"""
-        self.SPEversion = self._readAtNumpy(self.SPEVERSIONOFFSET, 1, pl.float32)[0]
+        """Determines SPE file version (always there in SPE 2.x or 3.0 files)
+        MUST BE CALLED AFTER _readHeader()"""
+        self.SPEversion = struct.unpack_from('<f', self._header, self.SPEVERSIONOFFSET)[0]
 
     def _readXMLfooter(self):
-        """Extracts the XML footer and puts it in _footerInfo as an ordered dictionnary (cf. xmltodict package)"""
-        XMLfooterPos = self._readAtNumpy(self.XMLFOOTEROFFSETPOS, 1, pl.uint64)[0]
+        """Extracts the XML footer: raw text in _footerXML and parsed root element (<SpeFormat>) in _footerTree
+        MUST BE CALLED AFTER _readHeader()"""
+        XMLfooterPos = struct.unpack_from('<Q', self._header, self.XMLFOOTEROFFSETPOS)[0]
         self._fid.seek(XMLfooterPos)
-        self._footerInfo = xmltodict.parse(self._fid.read())
+        self._footerXML = self._fid.read()
+        self._footerTree = ET.fromstring(self._footerXML)
+
+    def _findInFooter(self, path):
+        """Finds an element in the XML footer, ignoring XML namespaces (the footer uses several of them)
+        MUST BE CALLED AFTER _readXMLfooter()
+
+        Args:
+            path (str): tags separated by '/' leading to the element from the root <SpeFormat> element
+                (the first matching child is followed at each level)
+
+        Returns:
+            Element: the element found
+
+        Raises:
+            KeyError: if no element matches path
+        """
+        element = self._footerTree
+        for tag in path.split('/'):
+            element = next((child for child in element if _localTag(child) == tag), None)
+            if element is None:
+                raise KeyError(path)
+        return element
 
     def _readWavelengths(self):
         """Extracts the wavelength vector determined by spectrometer calibration"""
-        try:
-            wavelengthStr = self._footerInfo['SpeFormat']['Calibrations']['WavelengthMapping']['Wavelength']['#text']
-        except TypeError:  # will happen if <Wavelength> has no attributes (it happened). The ['#text'] won't exist then.
-            wavelengthStr = self._footerInfo['SpeFormat']['Calibrations']['WavelengthMapping']['Wavelength']
-        self.wavelength = pl.array([float(w) for w in wavelengthStr.split(',')])
+        wavelengthStr = self._findInFooter('Calibrations/WavelengthMapping/Wavelength').text
+        self.wavelength = _parseWavelengths(wavelengthStr).copy()
 
     def _readFramesInfo(self):
         """Extracts frames info from XML footer (number of frames, data type, frame size, frame stride)
         MUST BE CALLED AFTER _readXMLfooter()"""
-        assert(self._footerInfo['SpeFormat']['DataFormat']['DataBlock']['@type'] == 'Frame')
-        self.nbOfFrames = int(self._footerInfo['SpeFormat']['DataFormat']['DataBlock']['@count'])
-        dataTypeName = self._footerInfo['SpeFormat']['DataFormat']['DataBlock']['@pixelFormat']
-        possibleDataTypes = {'MonochromeUnsigned16': pl.uint16,
-                             'MonochromeUnsigned32': pl.uint32,
-                             'MonochromeFloat32': pl.float32,
-                             'MonochromeFloating32': pl.float32}
+        frameBlock = self._findInFooter('DataFormat/DataBlock')
+        assert(frameBlock.get('type') == 'Frame')
+        self.nbOfFrames = int(frameBlock.get('count'))
+        dataTypeName = frameBlock.get('pixelFormat')
+        possibleDataTypes = {'MonochromeUnsigned16': np.uint16,
+                             'MonochromeUnsigned32': np.uint32,
+                             'MonochromeFloat32': np.float32,
+                             'MonochromeFloating32': np.float32}
         self.dataType = possibleDataTypes[dataTypeName]
-        self.frameSize = int(self._footerInfo['SpeFormat']['DataFormat']['DataBlock']['@size'])
-        self.frameStride = int(self._footerInfo['SpeFormat']['DataFormat']['DataBlock']['@stride'])
+        self.frameSize = int(frameBlock.get('size'))
+        self.frameStride = int(frameBlock.get('stride'))
+        # frame size in number of pixels rather than bytes
+        self._itemsize = np.dtype(self.dataType).itemsize
+        self._framePixels = self.frameSize // self._itemsize
 
     def _readRegionSize(self):
         """Extracts width and height of the region of interest
         MUST BE CALLED AFTER _readXMLfooter()"""
-        self.roi_data = self._footerInfo['SpeFormat']['DataFormat']['DataBlock']['DataBlock']
+        frameBlock = self._findInFooter('DataFormat/DataBlock')
+        self.roi_data = [child for child in frameBlock if _localTag(child) == 'DataBlock']
+        if len(self.roi_data) == 0:
+            raise KeyError('DataFormat/DataBlock/DataBlock')
+        if len(self.roi_data) == 1:
+            self.roi_data = self.roi_data[0]
         if type(self.roi_data) == list:
             self.regionSize = list()
             self.n_roi = len(self.roi_data)
             for ROI in self.roi_data:
-                self.regionSize.append((int(ROI['@height']), int(ROI['@width'])))
+                self.regionSize.append((int(ROI.get('height')), int(ROI.get('width'))))
             print(self.regionSize)
         else:
-            assert(self.roi_data['@type'] == 'Region')
-            height = int(self.roi_data['@height'])
-            width = int(self.roi_data['@width'])
+            assert(self.roi_data.get('type') == 'Region')
+            height = int(self.roi_data.get('height'))
+            width = int(self.roi_data.get('width'))
             self.regionSize = (height,width)
         
     def _readExposureTime(self):
         """Extracts the camera exposure time
         MUST BE CALLED AFTER _readXMLfooter()"""
-        self.exposureTime = float(self._footerInfo['SpeFormat']['DataHistories']['DataHistory']['Origin']['Experiment']['Devices']['Cameras']['Camera']['ShutterTiming']['ExposureTime']['#text'])
+        self.exposureTime = float(self._findInFooter('DataHistories/DataHistory/Origin/Experiment/Devices/Cameras/Camera/ShutterTiming/ExposureTime').text)
         
     def _readArray(self):
-        """Reads the binary data contained in the file"""
-        if type(self.regionSize) == list:
-            multi_roi = True
-            self.data = {('r'+str(i)):[] for i in range(len(self.regionSize)) }
+        """Reads the binary data contained in the file (memory mapped if the file was opened from its filename)"""
+        if self._fname is not None:
+            # memory map the frames so that they are only loaded from disk when accessed (copy-on-write keeps data writable)
+            rawData = np.memmap(self._fname, dtype=np.uint8, mode='c', offset=self.DATAOFFSET,
+                                shape=(self.nbOfFrames * self.frameStride,))
+            # each frame starts every frameStride bytes (not always a whole number of pixels):
+            # view with byte strides to skip the padding/metadata between frames (if any)
+            frames = np.ndarray(buffer=rawData, dtype=self.dataType, shape=(self.nbOfFrames, self._framePixels),
+                                strides=(self.frameStride, self._itemsize))
         else:
-            multi_roi = False
-            self.data = []
-
-        for frameNb in range(self.nbOfFrames):
-            frameData = self._readAtNumpy(self.DATAOFFSET + frameNb * self.frameStride, self.frameSize / self.dataType().nbytes, self.dataType)
-            if multi_roi:
-                val_count = 0
-                for idx_ROI, ROI in enumerate(self.regionSize):
-                    roi_size = pl.array(self.regionSize[idx_ROI])
-                    roi_n_vals = pl.prod(roi_size)
-                    roi_name = 'r' + str(idx_ROI)
- 
-                    self.data[roi_name].append(frameData[val_count:(val_count+roi_n_vals)]\
-                            .reshape(roi_size))
-                    val_count += roi_n_vals
+            # read directly into a preallocated array (no padding kept, no intermediate copy)
+            frames = np.empty((self.nbOfFrames, self._framePixels), dtype=self.dataType)
+            if self.frameStride == self.frameSize:
+                self._fid.seek(self.DATAOFFSET)
+                if self._fid.readinto(frames.reshape(-1).view(np.uint8)) != frames.nbytes:
+                    raise EOFError('The file is too short to contain {} frames.'.format(self.nbOfFrames))
             else:
-                self.data.append(frameData.reshape(self.regionSize))
-        if multi_roi:
-            self.data = {k: pl.array(v) for k, v in self.data.items()}
+                for frameNb in range(self.nbOfFrames):
+                    self._fid.seek(self.DATAOFFSET + frameNb * self.frameStride)
+                    if self._fid.readinto(frames[frameNb].view(np.uint8)) != self.frameSize:
+                        raise EOFError('The file is too short to contain frame {}.'.format(frameNb))
+
+        if type(self.regionSize) == list:
+            self.data = dict()
+            val_count = 0
+            for idx_ROI, roi_size in enumerate(self.regionSize):
+                roi_n_vals = roi_size[0] * roi_size[1]
+                roi_name = 'r' + str(idx_ROI)
+                self.data[roi_name] = frames[:, val_count:(val_count+roi_n_vals)].reshape((self.nbOfFrames,) + roi_size)
+                val_count += roi_n_vals
         else:
-            self.data = pl.array(self.data)
+            self.data = frames.reshape((self.nbOfFrames,) + self.regionSize)
         
     def saveXMLinfo(self, filePath):
         """allows the user to save the XML footer to a file of his choice
@@ -200,36 +243,58 @@ class SPE3map:
         Args:
             filePath (str): filename of the XML file where to save the header.
         """
-        text_file = open(filePath, "w")
-        text_file.write(xmltodict.unparse(self._footerInfo))
+        text_file = open(filePath, "wb")
+        text_file.write(self._footerXML)
         text_file.close()
 
 
+def _exampleProcessFile(filename):
+    """Helper of the __main__ power dependence example only (not part of the SPE3map interface):
+    reads and filters the spectrum of one file of the example.
+    Defined at module level so that it can be sent to worker processes.
+
+    Args:
+        filename (str): SPE file named after the power (in units of 5 mW)
+
+    Returns:
+        tuple: (power in microwatts, wavelength vector, filtered spectrum, total signal)
+    """
+    from tools.arrayProcessing import filter_cosmic_rays
+
+    data = SPE3map(filename)
+    spectrum = data.data[0][0].astype(np.uint32)
+
+    spectrum = filter_cosmic_rays(spectrum, filter_size=7)
+#    spectrum = (spectrum - np.mean(spectrum[0:50])) / (data.exposureTime / 1000)
+
+    power, _ = os.path.splitext(filename)
+    return float(power) * 5000, data.wavelength, spectrum, np.sum(spectrum)  # power in microwatts
+
+
 if __name__ == "__main__":
+    import pylab as pl
     from tkinter.filedialog import askopenfilename
-    from tools.arrayProcessing import range_to_edge, filter_cosmic_rays
-    import glob, os
+    from tools.arrayProcessing import range_to_edge
+    from concurrent.futures import ProcessPoolExecutor
+    import glob
 
     os.chdir(r"/Users/raphaelproux/Desktop/mocvd-wse2/170904-4K-good-map/power-dep/")
+
+    # files are independent from each other: read and filter them in parallel, plot afterwards
+    with ProcessPoolExecutor() as executor:
+        results = list(executor.map(_exampleProcessFile, glob.glob("*.spe")))
+
     pl.figure()
     powers = []
     spectra = []
     signals = []
-    for filename in glob.glob("*.spe"):
-        data = SPE3map(filename)
-        spectrum = data.data[0][0].astype(pl.uint32)
-        
-        spectrum = filter_cosmic_rays(spectrum, filter_size=7)
-#        spectrum = (spectrum - pl.mean(spectrum[0:50])) / (data.exposureTime / 1000)
-        
+    for power, wavelength, spectrum, signal in results:
+        powers.append(power)
         spectra.append(spectrum)
+        signals.append(signal)
+        pl.plot(wavelength, spectrum / signal, label=r'${}\ \mu W$'.format(power))
         
-        power, _ = os.path.splitext(filename)
-        powers.append(float(power) * 5000)  # power in microwatts
-        signals.append(pl.sum(spectrum))
-        pl.plot(data.wavelength, spectrum / signals[-1], label=r'${}\ \mu W$'.format(powers[-1]))
-        
-#        pl.savetxt('{}.txt'.format(powers[-1]), pl.array([data.wavelength, spectrum / signals[-1]]).transpose())
+#        pl.savetxt('{}.txt'.format(power), pl.array([wavelength, spectrum / signal]).transpose())
         
     pl.legend()
     pl.figure()